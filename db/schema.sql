@@ -41,18 +41,23 @@ CREATE TABLE Category (
 CREATE INDEX idx_category_dataset_name
     ON Category(dataset_id, name);
 
+CREATE UNIQUE INDEX idx_category_dataset_external
+    ON Category(dataset_id, external_id);
+
 CREATE TABLE Annotation (
     annotation_id  INTEGER PRIMARY KEY AUTOINCREMENT,
     image_id       INTEGER NOT NULL,
     category_id    INTEGER NOT NULL,
-    bbox_xmin      REAL,
-    bbox_ymin      REAL,
-    bbox_width     REAL,
-    bbox_height    REAL,
+    bbox           BLOB,                    -- xmin, ymin, width, height as 4 little-endian
+                                            -- float32 (16 bytes); see bulk_load.py for the
+                                            -- bbox_xmin() ... bbox_area() SQL functions
     area           REAL,
     is_crowd       INTEGER,
     difficulty     INTEGER,
     source_info    TEXT,
+    flags_bits     INTEGER,                 -- OpenImages IsOccluded, IsTruncated, IsGroupOf,
+                                            -- IsDepiction, IsInside: 2 bits each from bit 0
+                                            -- (0 = no, 1 = yes, 3 = unknown/-1)
 
     FOREIGN KEY (image_id) REFERENCES Image(image_id),
     FOREIGN KEY (category_id) REFERENCES Category(category_id)
@@ -1,13 +1,45 @@
 import json
-import sqlite3
+import mmap
+from itertools import chain
 from pathlib import Path
 
+try:
+    # optional: streaming parser, used only with STREAM_ANNOTATIONS = True
+    import ijson.backends.yajl2_c as ijson
+except ImportError:
+    try:
+        import ijson   # pure-Python / cffi backend: same API, slower
+    except ImportError:
+        ijson = None
+
+try:
+    import simdjson   # optional (pysimdjson): SIMD parser with lazy field access
+except ImportError:
+    simdjson = None
+
+try:
+    import orjson   # optional: much faster parsing of the large COCO JSON files
+except ImportError:
+    orjson = None
+
+from bulk_load import (
+    BulkLoader,
+    batched_in_background,
+    bulk_load_connection,
+    bulk_transaction,
+    pack_bbox,
+)
+
 PROJECT_ROOT = Path(__file__).resolve().parents[1]
 DB_PATH = PROJECT_ROOT / "db" / "cv_datasets.db"
 DATA_DIR = PROJECT_ROOT / "data" / "COCO"
 
 COCO_DATASET_NAME = "COCO"   # must match name in Dataset table
 
+# True: stream annotations with ijson so memory stays bounded on small machines.
+# Reads each file three times and is several times slower than load_json().
+STREAM_ANNOTATIONS = False
+
 ANNOTATION_FILES = {
     "train": DATA_DIR / "instances_train2017.json",
     "val":   DATA_DIR / "instances_val2017.json",
@@ -24,92 +56,107 @@ def get_coco_dataset_id(conn):
     return row[0]
 
 def load_json(path: Path):
+    """
+    Parse a COCO annotation file, using the fastest parser installed:
+    pysimdjson (memory-mapped input; objects are only converted to Python
+    values when a field is read), then orjson, then the stdlib json module.
+    """
+    if simdjson is not None:
+        with path.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as view:
+                return simdjson.Parser().parse(view)
+    if orjson is not None:
+        return orjson.loads(path.read_bytes())
     with path.open("r", encoding="utf-8") as f:
         return json.load(f)
 
+def iter_json_items(path: Path, prefix):
+    """Stream the elements of one top-level array (prefix e.g. 'annotations.item') with ijson."""
+    with path.open("rb") as f:
+        yield from ijson.items(f, prefix, use_float=True)
+
+def load_coco(path: Path):
+    """
+    Return (categories, images, annotations) of a COCO annotation file.
+    With STREAM_ANNOTATIONS the small categories/images arrays are read
+    eagerly and annotations are a lazy ijson stream, so peak memory no longer
+    grows with the annotation count. Each array is a separate pass over the
+    file: one Python loop over ijson.parse() events costs more than the three
+    C-level ijson.items() passes. Otherwise the whole file is parsed with
+    load_json().
+    """
+    if STREAM_ANNOTATIONS:
+        if ijson is None:
+            raise ImportError("STREAM_ANNOTATIONS = True needs the ijson package.")
+        categories = list(iter_json_items(path, "categories.item"))
+        images = list(iter_json_items(path, "images.item"))
+        return categories, images, iter_json_items(path, "annotations.item")
+    data = load_json(path)
+    return data["categories"], data["images"], data["annotations"]
+
+def annotation_rows(annotations):
+    """
+    Yield BulkLoader.add_annotations() rows for COCO annotation dicts.
+    Runs once per annotation (~860k for train2017), so it keeps lookups to a minimum.
+    """
+    to_str = str
+    pack = pack_bbox
+    for ann in annotations:
+        xmin, ymin, width, height = ann["bbox"]
+        area = ann.get("area")
+        yield (
+            to_str(ann["image_id"]),
+            to_str(ann["category_id"]),
+            pack(xmin, ymin, width, height),
+            width * height if area is None else area,
+            ann.get("iscrowd"),
+            None,
+            None,
+            None,
+        )
+
 def main():
     # Check files exist
     missing = [str(p) for p in ANNOTATION_FILES.values() if not p.exists()]
     if missing:
         raise FileNotFoundError("Missing COCO JSON files:\n" + "\n".join(missing))
 
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("PRAGMA foreign_keys = ON;")
-    coco_dataset_id = get_coco_dataset_id(conn)
-
-    print(f"Using dataset_id={coco_dataset_id} for COCO.")
-
-    image_count = 0
-    ann_count = 0
-    category_mapping = {}  # coco_category_id → category_id in DB
-
-    with conn:
-        for split, json_file in ANNOTATION_FILES.items():
-            print(f"Processing {json_file}...")
-
-            data = load_json(json_file)
-
-            # Insert categories once
-            for cat in data["categories"]:
-                coco_id = cat["id"]
-                if coco_id not in category_mapping:
-                    cur = conn.execute(
-                        """
-                        INSERT INTO Category (dataset_id, name, supercategory, external_id)
-                        VALUES (?, ?, ?, ?)
-                        """,
-                        (coco_dataset_id, cat["name"], cat["supercategory"], str(coco_id))
-                    )
-                    category_mapping[coco_id] = cur.lastrowid
-
-            # Insert images
-            image_id_map = {}  # COCO image id → our DB image_id
-            for img in data["images"]:
-                cur = conn.execute(
-                    """
-                    INSERT INTO Image (dataset_id, external_id, width, height, file_path, split)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                    """,
-                    (coco_dataset_id, str(img["id"]), img["width"], img["height"], None, split)
+    with bulk_load_connection(DB_PATH) as conn:
+        coco_dataset_id = get_coco_dataset_id(conn)
+
+        print(f"Using dataset_id={coco_dataset_id} for COCO.")
+
+        image_count = 0
+        ann_count = 0
+
+        with bulk_transaction(conn):
+            loader = BulkLoader(conn, coco_dataset_id)
+            for split, json_file in ANNOTATION_FILES.items():
+                print(f"Processing {json_file}...")
+
+                categories, images, annotations = load_coco(json_file)
+
+                # Insert categories once (the val file repeats the train categories)
+                loader.add_categories(
+                    (cat["name"], cat["supercategory"], str(cat["id"])) for cat in categories
                 )
-                image_id_map[img["id"]] = cur.lastrowid
-                image_count += 1
-
-            # Insert annotations
-            for ann in data["annotations"]:
-                img_pk = image_id_map.get(ann["image_id"])
-                cat_pk = category_mapping.get(ann["category_id"])
-
-                bbox = ann["bbox"]  # [xmin, ymin, width, height]
-                bbox_xmin = bbox[0]
-                bbox_ymin = bbox[1]
-                bbox_width = bbox[2]
-                bbox_height = bbox[3]
-                area = ann.get("area", bbox_width * bbox_height)
-
-                conn.execute(
-                    """
-                    INSERT INTO Annotation
-                        (image_id, category_id,
-                         bbox_xmin, bbox_ymin,
-                         bbox_width, bbox_height,
-                         area, is_crowd, difficulty, source_info)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    """,
-                    (
-                        img_pk, cat_pk,
-                        bbox_xmin, bbox_ymin,
-                        bbox_width, bbox_height,
-                        area,
-                        ann.get("iscrowd", None),
-                        None,
-                        None,
-                    )
+
+                # Insert images
+                image_count += loader.add_images(
+                    (str(img["id"]), img["width"], img["height"], None, split)
+                    for img in images
+                )
+
+                # Insert annotations; COCO image/category ids are resolved to PKs in SQL.
+                # Rows are built in a background thread while this one inserts.
+                ann_count += loader.add_annotations(
+                    chain.from_iterable(batched_in_background(annotation_rows(annotations)))
                 )
-                ann_count += 1
 
-    conn.close()
-    print(f"Inserted {image_count} COCO images, {len(category_mapping)} categories, {ann_count} annotations.")
+        (category_count,) = conn.execute(
+            "SELECT COUNT(*) FROM Category WHERE dataset_id = ?", (coco_dataset_id,)
+        ).fetchone()
+    print(f"Inserted {image_count} COCO images, {category_count} categories, {ann_count} annotations.")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
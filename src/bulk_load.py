@@ -0,0 +1,325 @@
+"""
+Helpers shared by the dataset importers for loading large batches of rows
+into the unified SQLite database.
+"""
+import sqlite3
+import struct
+from contextlib import contextmanager
+from itertools import islice
+from queue import Queue
+from threading import Thread
+
+BATCH_SIZE = 10_000   # rows per executemany() call
+PIPELINE_DEPTH = 4    # batches buffered between the parsing and inserting threads
+
+# connection settings used while an importer is running; none of these
+# except journal_mode are stored in the database file
+BULK_LOAD_PRAGMAS = (
+    "PRAGMA journal_mode = WAL;",
+    "PRAGMA synchronous = OFF;",
+    "PRAGMA temp_store = MEMORY;",
+    "PRAGMA cache_size = -262144;",       # 256 MiB page cache
+    "PRAGMA locking_mode = EXCLUSIVE;",
+)
+
+# tables whose non-UNIQUE indexes are dropped during the load and rebuilt after
+BULK_LOAD_TABLES = ("Image", "Category", "Annotation")
+
+# Annotation.bbox: xmin, ymin, width, height packed as 4 little-endian float32
+BBOX_STRUCT = struct.Struct("<4f")
+BBOX_DTYPE = "<f4"   # numpy dtype of one BBOX_STRUCT field; change both together
+pack_bbox = BBOX_STRUCT.pack
+
+# sqlite3 keeps compiled statements per connection, keyed by the exact SQL text
+CACHED_STATEMENTS = 256
+
+INSERT_IMAGE_SQL = """
+INSERT INTO Image (dataset_id, external_id, width, height, file_path, split)
+VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+# (dataset_id, external_id) is UNIQUE, so categories seen before are skipped
+INSERT_CATEGORY_SQL = """
+INSERT OR IGNORE INTO Category (dataset_id, name, supercategory, external_id)
+VALUES (?, ?, ?, ?)
+"""
+
+# annotations are staged with the dataset's own ids and resolved to PKs in SQL
+CREATE_ANNOTATION_STAGING_SQL = """
+CREATE TEMP TABLE IF NOT EXISTS ann_stg (
+    ext_image_id  TEXT,
+    ext_cat_id    TEXT,
+    bbox          BLOB,
+    area          REAL,
+    is_crowd      INTEGER,
+    difficulty    INTEGER,
+    source_info   TEXT,
+    flags_bits    INTEGER
+)
+"""
+
+RESOLVE_STAGED_ANNOTATIONS_SQL = """
+INSERT INTO Annotation
+    (image_id, category_id, bbox,
+     area, is_crowd, difficulty, source_info, flags_bits)
+SELECT i.image_id, c.category_id, s.bbox,
+       s.area, s.is_crowd, s.difficulty, s.source_info, s.flags_bits
+FROM ann_stg s
+JOIN Image i    ON i.dataset_id = ? AND i.external_id = s.ext_image_id
+JOIN Category c ON c.dataset_id = ? AND c.external_id = s.ext_cat_id
+ORDER BY s.rowid
+"""
+
+# staged rows the JOIN above dropped because their image or category is missing
+SELECT_UNRESOLVED_ANNOTATIONS_SQL = """
+SELECT * FROM ann_stg s
+WHERE NOT EXISTS (SELECT 1 FROM Image i
+                  WHERE i.dataset_id = ? AND i.external_id = s.ext_image_id)
+   OR NOT EXISTS (SELECT 1 FROM Category c
+                  WHERE c.dataset_id = ? AND c.external_id = s.ext_cat_id)
+ORDER BY s.rowid
+"""
+
+STAGE_ANNOTATION_SQL = "INSERT INTO ann_stg VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+
+
+def batched(rows, size=BATCH_SIZE):
+    """Yield lists of up to `size` rows from any iterable."""
+    it = iter(rows)
+    while batch := list(islice(it, size)):
+        yield batch
+
+
+def batched_in_background(rows, size=BATCH_SIZE, depth=PIPELINE_DEPTH):
+    """
+    Like batched(), but `rows` is consumed by a producer thread, so parsing
+    the next batches overlaps with whatever the caller does with this one
+    (typically executemany, which releases the GIL inside SQLite).
+    At most `depth` batches wait in the queue. Errors raised while producing
+    are re-raised in the caller.
+    """
+    queue = Queue(maxsize=depth)
+    done = object()
+
+    def produce():
+        try:
+            for batch in batched(rows, size):
+                queue.put(batch)
+        except BaseException as exc:
+            queue.put(exc)
+        else:
+            queue.put(done)
+
+    # daemon: if the caller stops early the producer may stay blocked on put()
+    Thread(target=produce, name="bulk-load-producer", daemon=True).start()
+    while (item := queue.get()) is not done:
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+class BulkLoader:
+    """
+    Inserts Image, Category and Annotation rows for one dataset.
+    Each kind of row always goes through its own cursor with the same SQL
+    string, so every statement is compiled once per connection and reused.
+    Create it inside bulk_transaction().
+    """
+
+    def __init__(self, conn: sqlite3.Connection, dataset_id: int):
+        self.conn = conn
+        self.dataset_id = dataset_id
+        conn.execute(CREATE_ANNOTATION_STAGING_SQL)
+        self._image_cur = conn.cursor()
+        self._category_cur = conn.cursor()
+        self._stage_cur = conn.cursor()
+        self._resolve_cur = conn.cursor()
+
+    def add_images(self, rows) -> int:
+        """
+        Insert (external_id, width, height, file_path, split) rows.
+        Returns the number inserted.
+        """
+        count = 0
+        dataset_id = self.dataset_id
+        for batch in batched(rows):
+            self._image_cur.executemany(INSERT_IMAGE_SQL, [(dataset_id, *row) for row in batch])
+            count += len(batch)
+        return count
+
+    def add_categories(self, rows):
+        """Insert (name, supercategory, external_id) rows; existing external_ids are skipped."""
+        dataset_id = self.dataset_id
+        self._category_cur.executemany(INSERT_CATEGORY_SQL, [(dataset_id, *row) for row in rows])
+
+    def add_annotations(self, rows, on_unresolved=None) -> int:
+        """
+        Insert annotations whose image and category are given by external_id:
+          (ext_image_id, ext_cat_id, bbox, area, is_crowd, difficulty,
+           source_info, flags_bits)
+        where bbox comes from pack_bbox(xmin, ymin, width, height).
+        Each batch is staged in a TEMP table and joined against the UNIQUE
+        (dataset_id, external_id) indexes on Image and Category, so no id maps are
+        kept in Python. Images and categories must already be inserted.
+
+        Rows whose image or category is missing raise sqlite3.IntegrityError,
+        unless `on_unresolved` is given: it is called with the list of those
+        rows (in input order) and may insert what they need. The batch's first
+        insert is then rolled back to a savepoint and the whole batch resolved
+        again, so annotation_ids still follow the input order; rows still
+        unresolved then raise.
+        Returns the number inserted.
+        """
+        count = 0
+        for batch in batched(rows):
+            self._stage(batch)
+            if on_unresolved is None:
+                inserted = self._resolve_staged()
+            else:
+                self._stage_cur.execute("SAVEPOINT resolve_batch")
+                inserted = self._resolve_staged()
+                if inserted < len(batch):
+                    self._stage_cur.execute("ROLLBACK TO resolve_batch")
+                    on_unresolved(self._unresolved_staged())
+                    inserted = self._resolve_staged()
+                self._stage_cur.execute("RELEASE resolve_batch")
+            if inserted < len(batch):
+                missing = self._unresolved_staged()
+                raise sqlite3.IntegrityError(
+                    f"{len(missing)} annotation(s) reference an image or category missing "
+                    f"from dataset {self.dataset_id}, e.g. (image, category) = {missing[0][:2]}"
+                )
+            count += inserted
+        return count
+
+    def _stage(self, batch):
+        """Replace the contents of ann_stg with `batch`."""
+        self._stage_cur.execute("DELETE FROM ann_stg")
+        self._stage_cur.executemany(STAGE_ANNOTATION_SQL, batch)
+
+    def _resolve_staged(self) -> int:
+        """Insert the staged rows into Annotation; returns the number inserted."""
+        params = (self.dataset_id, self.dataset_id)
+        return self._resolve_cur.execute(RESOLVE_STAGED_ANNOTATIONS_SQL, params).rowcount
+
+    def _unresolved_staged(self):
+        """Rows of ann_stg whose image or category does not exist (yet)."""
+        params = (self.dataset_id, self.dataset_id)
+        return self._resolve_cur.execute(SELECT_UNRESOLVED_ANNOTATIONS_SQL, params).fetchall()
+
+
+def register_bbox_functions(conn: sqlite3.Connection):
+    """
+    Add bbox_xmin(), bbox_ymin(), bbox_width(), bbox_height() and bbox_area()
+    SQL functions that unpack an Annotation.bbox blob at query time, e.g.
+      SELECT bbox_width(bbox) FROM Annotation WHERE bbox_area(bbox) > 100
+    """
+    unpack = BBOX_STRUCT.unpack
+
+    def field(i):
+        return lambda blob: None if blob is None else unpack(blob)[i]
+
+    def area(blob):
+        if blob is None:
+            return None
+        _, _, width, height = unpack(blob)
+        return width * height
+
+    for i, name in enumerate(("bbox_xmin", "bbox_ymin", "bbox_width", "bbox_height")):
+        conn.create_function(name, 1, field(i), deterministic=True)
+    conn.create_function("bbox_area", 1, area, deterministic=True)
+
+
+def connect(db_path) -> sqlite3.Connection:
+    """
+    Open the database for an import. The connection is in autocommit mode
+    (isolation_level=None) so the driver never opens implicit transactions;
+    bulk_transaction() issues BEGIN/COMMIT itself. It may be used from a
+    worker thread. Foreign keys are enforced. The statement cache is large
+    enough to keep every importer's INSERTs compiled at the same time.
+    """
+    conn = sqlite3.connect(
+        db_path,
+        isolation_level=None,
+        check_same_thread=False,
+        cached_statements=CACHED_STATEMENTS,
+    )
+    conn.execute("PRAGMA foreign_keys = ON;")
+    return conn
+
+
+def tune_for_bulk_load(conn: sqlite3.Connection):
+    """
+    Trade durability for insert speed for the lifetime of `conn`.
+    A crash mid-import can leave a half-written database; rerun init_db.py.
+    """
+    for pragma in BULK_LOAD_PRAGMAS:
+        conn.execute(pragma)
+
+
+def drop_secondary_indexes(conn: sqlite3.Connection, tables=BULK_LOAD_TABLES):
+    """
+    Drop the non-UNIQUE indexes on `tables` and return their CREATE INDEX
+    statements for rebuild_indexes(). UNIQUE indexes stay, since
+    BulkLoader's staging join and INSERT OR IGNORE rely on them.
+    """
+    ddl = []
+    for table in tables:
+        for _, name, unique, origin, _ in conn.execute(f"PRAGMA index_list({table})").fetchall():
+            if unique or origin != "c":
+                continue
+            (sql,) = conn.execute(
+                "SELECT sql FROM sqlite_master WHERE type = 'index' AND name = ?", (name,)
+            ).fetchone()
+            conn.execute(f'DROP INDEX "{name}"')
+            ddl.append(sql)
+    return ddl
+
+
+def rebuild_indexes(conn: sqlite3.Connection, ddl):
+    """Recreate indexes dropped by drop_secondary_indexes(); each is built in one sorted pass."""
+    for sql in ddl:
+        conn.execute(sql)
+
+
+def finish_bulk_load(conn: sqlite3.Connection):
+    """Put the database file back into rollback-journal mode and refresh planner stats."""
+    conn.execute("PRAGMA journal_mode = DELETE;")
+    conn.execute("PRAGMA optimize;")
+
+
+@contextmanager
+def bulk_load_connection(db_path):
+    """
+    connect() and tune_for_bulk_load() for one import. On exit, successful
+    or not, finish_bulk_load() puts the file back into rollback-journal
+    mode (WAL would persist after a failed import) and the connection is closed.
+    """
+    conn = connect(db_path)
+    try:
+        tune_for_bulk_load(conn)
+        yield conn
+    finally:
+        try:
+            finish_bulk_load(conn)
+        finally:
+            conn.close()
+
+
+@contextmanager
+def bulk_transaction(conn: sqlite3.Connection):
+    """
+    Run the whole import as one write transaction.
+    Secondary indexes are dropped for the duration and rebuilt before COMMIT.
+    Commits on success, rolls back everything (indexes included) on any error.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        dropped = drop_secondary_indexes(conn)
+        yield conn
+        rebuild_indexes(conn, dropped)
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
@@ -1,7 +1,21 @@
 import sqlite3
+from concurrent.futures import ProcessPoolExecutor
 import xml.etree.ElementTree as ET
 from pathlib import Path
 
+try:
+    from lxml import etree   # optional: libxml2 parser + precompiled XPath
+except ImportError:
+    etree = None
+
+from bulk_load import (
+    BulkLoader,
+    batched_in_background,
+    bulk_load_connection,
+    bulk_transaction,
+    pack_bbox,
+)
+
 PROJECT_ROOT = Path(__file__).resolve().parents[1]
 DB_PATH = PROJECT_ROOT / "db" / "cv_datasets.db"
 
@@ -15,6 +29,25 @@ IMAGESETS_MAIN = DATA_DIR / "ImageSets" / "Main"
 ANNOTATIONS_DIR = DATA_DIR / "Annotations"
 IMAGES_DIR = DATA_DIR / "JPEGImages"
 
+XML_BATCH_SIZE = 500   # parsed XML files per insert batch
+
+if etree is not None:
+    # compiled once and reused for every XML file
+    def _xpath_text(path):
+        return etree.XPath(f"string({path})", smart_strings=False)
+
+    _OBJECTS = etree.XPath("object")
+    _WIDTH = _xpath_text("size/width")
+    _HEIGHT = _xpath_text("size/height")
+    _NAME = _xpath_text("name")
+    _DIFFICULT = _xpath_text("difficult")
+    _TRUNCATED = _xpath_text("truncated")
+    _POSE = _xpath_text("pose")
+    _XMIN = _xpath_text("bndbox/xmin")
+    _YMIN = _xpath_text("bndbox/ymin")
+    _XMAX = _xpath_text("bndbox/xmax")
+    _YMAX = _xpath_text("bndbox/ymax")
+
 
 def get_voc_dataset_id(conn: sqlite3.Connection) -> int:
     cur = conn.execute(
@@ -35,26 +68,24 @@ def load_split_lists():
     Read train/val/test image ids from ImageSets/Main.
     Returns dict: image_id (str) -> split ('train'/'val'/'test')
     """
-    splits = {}
 
-    def add_split(split_name: str, filename: str):
+    def read_ids(split_name: str, filename: str):
         path = IMAGESETS_MAIN / filename
         if not path.exists():
             print(f"[WARN] Missing split file: {path} (skipping {split_name})")
-            return
-        with path.open("r") as f:
-            for line in f:
-                img_id = line.strip()
-                if not img_id:
-                    continue
-                # if an id appears in multiple files, keep the first split encountered
-                splits.setdefault(img_id, split_name)
+            return set()
+        return set(path.read_text().split())
 
-    add_split("train", "train.txt")
-    add_split("val", "val.txt")
-    add_split("test", "test.txt")
+    train = read_ids("train", "train.txt")
+    # if an id appears in multiple files, keep the first split: train, then val, then test
+    val = read_ids("val", "val.txt") - train
+    test = read_ids("test", "test.txt") - train - val
 
-    return splits
+    return {
+        **dict.fromkeys(train, "train"),
+        **dict.fromkeys(val, "val"),
+        **dict.fromkeys(test, "test"),
+    }
 
 
 def parse_annotation_xml(xml_path: Path):
@@ -64,8 +95,43 @@ def parse_annotation_xml(xml_path: Path):
       width, height, objects
     where objects is a list of dicts:
       { 'name', 'xmin', 'ymin', 'xmax', 'ymax', 'difficult', 'truncated', 'pose' }
+    Uses lxml when it is installed, otherwise xml.etree.
     """
-    tree = ET.parse(xml_path)
+    if etree is None:
+        return _parse_annotation_xml_stdlib(xml_path)
+
+    try:
+        root = etree.parse(str(xml_path)).getroot()
+    except etree.XMLSyntaxError as exc:
+        # lxml errors can't be pickled back from a worker process
+        raise ValueError(f"{xml_path}: {exc}") from None
+    width = int(_WIDTH(root))
+    height = int(_HEIGHT(root))
+
+    objects = []
+    for obj in _OBJECTS(root):
+        objects.append(
+            {
+                "name": _NAME(obj),
+                "xmin": int(float(_XMIN(obj))),
+                "ymin": int(float(_YMIN(obj))),
+                "xmax": int(float(_XMAX(obj))),
+                "ymax": int(float(_YMAX(obj))),
+                "difficult": int(_DIFFICULT(obj) or 0),
+                "truncated": int(_TRUNCATED(obj) or 0),
+                "pose": _POSE(obj),
+            }
+        )
+
+    return width, height, objects
+
+
+def _parse_annotation_xml_stdlib(xml_path: Path):
+    try:
+        tree = ET.parse(xml_path)
+    except ET.ParseError as exc:
+        # same error as the lxml path, so the failing file is named
+        raise ValueError(f"{xml_path}: {exc}") from None
     root = tree.getroot()
 
     size = root.find("size")
@@ -110,103 +176,80 @@ def main():
     if not ANNOTATIONS_DIR.exists() or not IMAGES_DIR.exists():
         raise FileNotFoundError("Annotations or JPEGImages directory missing under VOC2007.")
 
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("PRAGMA foreign_keys = ON;")
-
-    dataset_id = get_voc_dataset_id(conn)
-    print(f"Using dataset_id={dataset_id} for VOC2007.")
-
-    # 1) load split mapping
-    imgid_to_split = load_split_lists()
-    print(f"Loaded {len(imgid_to_split)} image ids with split info.")
-
-    # 2) walk all annotation XMLs
-    xml_files = sorted(ANNOTATIONS_DIR.glob("*.xml"))
-    print(f"Found {len(xml_files)} annotation XML files.")
-
-    category_name_to_id = {}  # 'person' -> category_id
-    image_count = 0
-    ann_count = 0
-
-    with conn:
-        for xml_path in xml_files:
-            img_id = xml_path.stem  # e.g. "000001"
-            split = imgid_to_split.get(img_id, None)
-            # if you only want images that appear in some split, skip those without split
-            if split is None:
-                # uncomment this line if you want to skip unsplit images
-                # continue
-                split = "train"  # or default
-
-            width, height, objects = parse_annotation_xml(xml_path)
-
-            # insert Image row
-            file_path = str((IMAGES_DIR / f"{img_id}.jpg").relative_to(PROJECT_ROOT))
-            cur = conn.execute(
-                """
-                INSERT INTO Image (dataset_id, external_id, width, height, file_path, split)
-                VALUES (?, ?, ?, ?, ?, ?)
-                """,
-                (dataset_id, img_id, width, height, file_path, split),
-            )
-            image_pk = cur.lastrowid
-            image_count += 1
-
-            # insert Annotations & Categories
-            for obj in objects:
-                cat_name = obj["name"]
-                if cat_name not in category_name_to_id:
-                    cur = conn.execute(
-                        """
-                        INSERT INTO Category (dataset_id, name, supercategory, external_id)
-                        VALUES (?, ?, ?, ?)
-                        """,
-                        (dataset_id, cat_name, None, cat_name),
+    with bulk_load_connection(DB_PATH) as conn:
+        dataset_id = get_voc_dataset_id(conn)
+        print(f"Using dataset_id={dataset_id} for VOC2007.")
+
+        # 1) load split mapping
+        imgid_to_split = load_split_lists()
+        print(f"Loaded {len(imgid_to_split)} image ids with split info.")
+
+        # 2) list all annotation XMLs
+        xml_files = sorted(ANNOTATIONS_DIR.glob("*.xml"))
+        print(f"Found {len(xml_files)} annotation XML files.")
+
+        image_count = 0
+        ann_count = 0
+        category_names = {}   # class names in order of first appearance
+
+        # 3) parse the XMLs in worker processes; map() keeps file order.
+        # Workers are started before the write transaction is opened.
+        with ProcessPoolExecutor() as pool:
+            parsed = pool.map(parse_annotation_xml, xml_files, chunksize=64)
+
+            def parsed_images():
+                for xml_path, (width, height, objects) in zip(xml_files, parsed):
+                    img_id = xml_path.stem  # e.g. "000001"
+                    split = imgid_to_split.get(img_id, None)
+                    # if you only want images that appear in some split, skip those without split
+                    if split is None:
+                        # uncomment this line if you want to skip unsplit images
+                        # continue
+                        split = "train"  # or default
+
+                    file_path = str((IMAGES_DIR / f"{img_id}.jpg").relative_to(PROJECT_ROOT))
+                    yield (img_id, width, height, file_path, split), objects
+
+            with bulk_transaction(conn):
+                loader = BulkLoader(conn, dataset_id)
+                # results are drained in a background thread while this one inserts
+                for batch in batched_in_background(parsed_images(), size=XML_BATCH_SIZE):
+                    # 4) insert Image rows
+                    image_count += loader.add_images(image_row for image_row, _ in batch)
+
+                    # 5) insert Categories not seen in earlier batches
+                    batch_names = dict.fromkeys(
+                        obj["name"] for _, objects in batch for obj in objects
                     )
-                    category_name_to_id[cat_name] = cur.lastrowid
-
-                category_id = category_name_to_id[cat_name]
-
-                xmin = obj["xmin"]
-                ymin = obj["ymin"]
-                xmax = obj["xmax"]
-                ymax = obj["ymax"]
-
-                bbox_xmin = float(xmin)
-                bbox_ymin = float(ymin)
-                bbox_width = float(xmax - xmin)
-                bbox_height = float(ymax - ymin)
-                area = bbox_width * bbox_height
-
-                source_info = f"truncated={obj['truncated']};pose={obj['pose']}"
-
-                conn.execute(
-                    """
-                    INSERT INTO Annotation
-                        (image_id, category_id,
-                         bbox_xmin, bbox_ymin, bbox_width, bbox_height,
-                         area, is_crowd, difficulty, source_info)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    """,
-                    (
-                        image_pk,
-                        category_id,
-                        bbox_xmin,
-                        bbox_ymin,
-                        bbox_width,
-                        bbox_height,
-                        area,
-                        None,                      # is_crowd (not used in VOC)
-                        obj["difficult"],          # difficulty flag
-                        source_info,
-                    ),
-                )
-                ann_count += 1
-
-    conn.close()
+                    new_names = [name for name in batch_names if name not in category_names]
+                    loader.add_categories((cat_name, None, cat_name) for cat_name in new_names)
+                    category_names.update(dict.fromkeys(new_names))
+
+                    # 6) insert Annotations; file stem and class name are resolved to PKs in SQL
+                    def annotation_rows():
+                        for image_row, objects in batch:
+                            img_id = image_row[0]
+                            for obj in objects:
+                                xmin = obj["xmin"]
+                                ymin = obj["ymin"]
+                                bbox_width = float(obj["xmax"] - xmin)
+                                bbox_height = float(obj["ymax"] - ymin)
+
+                                yield (
+                                    img_id,
+                                    obj["name"],
+                                    pack_bbox(xmin, ymin, bbox_width, bbox_height),
+                                    bbox_width * bbox_height,  # area
+                                    None,                      # is_crowd (not used in VOC)
+                                    obj["difficult"],          # difficulty flag
+                                    f"truncated={obj['truncated']};pose={obj['pose']}",
+                                    None,                      # flags_bits (OpenImages only)
+                                )
+
+                    ann_count += loader.add_annotations(annotation_rows())
     print(
         f"Done. Inserted {image_count} VOC images, "
-        f"{len(category_name_to_id)} categories, {ann_count} annotations."
+        f"{len(category_names)} categories, {ann_count} annotations."
     )
 
 
@@ -1,7 +1,28 @@
 import csv
+import os
+import random
 import sqlite3
 from pathlib import Path
 
+try:
+    # optional: multi-threaded C CSV parser + numpy bbox arithmetic per batch
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from pyarrow import csv as pa_csv
+except ImportError:
+    pa = None
+
+from bulk_load import (
+    BBOX_DTYPE,
+    BBOX_STRUCT,
+    BulkLoader,
+    batched_in_background,
+    bulk_load_connection,
+    bulk_transaction,
+    pack_bbox,
+)
+
 # -------- settings --------
 PROJECT_ROOT = Path(__file__).resolve().parents[1]
 DB_PATH = PROJECT_ROOT / "db" / "cv_datasets.db"
@@ -10,6 +31,8 @@ DB_PATH = PROJECT_ROOT / "db" / "cv_datasets.db"
 DATA_DIR = PROJECT_ROOT / "data" / "Openimages"
 
 TARGET_IMAGE_COUNT = 17125   # or any number you want to sample
+SAMPLE_SEED = 0              # fixed so reruns pick the same images
+MAX_SAMPLE_ROUNDS = 8        # redraws to replace duplicate / URL-less picks
 
 BOX_FILES = {
     "train":      DATA_DIR / "train-annotations-bbox.csv",
@@ -25,6 +48,7 @@ IMAGE_INFO_FILES = {
 
 CLASS_DESCRIPTIONS = DATA_DIR / "oidv7-class-descriptions-boxable.csv"
 OI_DATASET_NAME = "OpenImagesV7"   # must match the name in Dataset table
+ARROW_BLOCK_SIZE = 16 << 20        # bytes of CSV per pyarrow record batch
 # --------------------------
 
 
@@ -67,68 +91,201 @@ def read_class_names(path: Path):
     return mid_to_name
 
 
+# packed into Annotation.flags_bits, 2 bits per flag (value & 3) starting at bit 0
+BOX_FLAG_COLUMNS = ("IsOccluded", "IsTruncated", "IsGroupOf", "IsDepiction", "IsInside")
+
+
+def _image_info_columns(fieldnames, path: Path):
+    """
+    Find the ImageID column even if the header name is slightly different,
+    plus the URL columns in preference order (smaller thumbnail first).
+    Returns (id_index, url_indexes).
+    """
+    fieldnames = [fn.strip() for fn in fieldnames]
+    col = {name: i for i, name in enumerate(fieldnames)}
+
+    # try common variants
+    id_idx = next(
+        (col[c] for c in ("ImageID", "ImageId", "image_id", "imageID") if c in col),
+        None,
+    )
+    if id_idx is None:
+        raise KeyError(
+            f"No ImageID-like column found in {path}. "
+            f"Available columns: {fieldnames}"
+        )
+    url_idxs = [col[c] for c in ("Thumbnail300KURL", "OriginalURL") if c in col]
+    return id_idx, url_idxs
+
+
 def iter_image_info(paths_by_split):
     """
-    Iterate image info rows across splits.
-    Tries to find the ImageID column even if the header name is slightly different.
+    Iterate image info rows across splits, yielding (split, image_id, file_url).
+    file_url prefers the smaller thumbnail and falls back to OriginalURL ('' if neither).
     """
     for split, path in paths_by_split.items():
         with path.open(newline="", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            # figure out which column holds the image id
-            fieldnames = [fn.strip() for fn in reader.fieldnames or []]
-
-            # try common variants
-            id_key = None
-            for candidate in ("ImageID", "ImageId", "image_id", "imageID"):
-                for fn in fieldnames:
-                    if fn == candidate:
-                        id_key = fn
-                        break
-                if id_key:
-                    break
-
-            if id_key is None:
-                raise KeyError(
-                    f"No ImageID-like column found in {path}. "
-                    f"Available columns: {fieldnames}"
-                )
+            reader = csv.reader(f)
+            id_idx, url_idxs = _image_info_columns(next(reader, None) or [], path)
 
             for row in reader:
-                # make sure we access the correct key as it appears in the CSV
-                yield split, row[id_key], row
+                if not row:
+                    continue   # blank line
+                file_url = next((row[i] for i in url_idxs if row[i]), "")
+                yield split, row[id_idx], file_url
 
 
-def iter_boxes(paths_by_split):
+def iter_boxes(paths_by_split, image_ids):
     """
-    Iterate bbox annotations across splits.
+    Iterate bbox annotations across splits, keeping only boxes of `image_ids`.
     CSV columns include:
       ImageID,Source,LabelName,Confidence,XMin,XMax,YMin,YMax,
       IsOccluded,IsTruncated,IsGroupOf,IsDepiction,IsInside,...
+    Yields (image_id, label_mid, bbox, area, flags_bits) where bbox is the
+    pack_bbox() blob of (xmin, ymin, width, height) and flags_bits packs
+    the BOX_FLAG_COLUMNS; a missing or empty flag counts as 0.
+    Uses pyarrow's streaming CSV reader when it is installed.
     """
-    for split, path in paths_by_split.items():
+    if pa is not None:
+        yield from _iter_boxes_arrow(paths_by_split, image_ids)
+        return
+
+    for path in paths_by_split.values():
         with path.open(newline="", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
+            reader = csv.reader(f)
+            header = [fn.strip() for fn in next(reader, None) or []]
+            col = {name: i for i, name in enumerate(header)}
+            i_id, i_label = col["ImageID"], col["LabelName"]
+            i_xmin, i_xmax, i_ymin, i_ymax = col["XMin"], col["XMax"], col["YMin"], col["YMax"]
+            flag_shifts = [
+                (col[name], 2 * bit) for bit, name in enumerate(BOX_FLAG_COLUMNS) if name in col
+            ]
+
             for row in reader:
-                yield split, row
+                if not row or row[i_id] not in image_ids:
+                    continue
+                xmin = float(row[i_xmin])
+                ymin = float(row[i_ymin])
+                width = float(row[i_xmax]) - xmin
+                height = float(row[i_ymax]) - ymin
+                yield (
+                    row[i_id],
+                    row[i_label],
+                    pack_bbox(xmin, ymin, width, height),
+                    width * height,
+                    sum((int(row[i] or 0) & 3) << shift for i, shift in flag_shifts),
+                )
 
 
-def choose_images(image_info_iter, limit):
+def _iter_boxes_arrow(paths_by_split, image_ids):
+    """pyarrow version of iter_boxes(): filtering, bbox math and packing run per record batch."""
+    wanted = pa.array(list(image_ids), type=pa.string())
+    convert_options = pa_csv.ConvertOptions(
+        column_types={
+            "ImageID": pa.string(),
+            "LabelName": pa.string(),
+            **dict.fromkeys(("XMin", "XMax", "YMin", "YMax"), pa.float64()),
+            **dict.fromkeys(BOX_FLAG_COLUMNS, pa.int8()),
+        },
+        include_columns=["ImageID", "LabelName", "XMin", "XMax", "YMin", "YMax", *BOX_FLAG_COLUMNS],
+        include_missing_columns=True,
+    )
+    for path in paths_by_split.values():
+        # header names are stripped like in the csv.reader version
+        with path.open(newline="", encoding="utf-8") as f:
+            header = [fn.strip() for fn in next(csv.reader(f), None) or []]
+        read_options = pa_csv.ReadOptions(
+            block_size=ARROW_BLOCK_SIZE, column_names=header, skip_rows=1
+        )
+        reader = pa_csv.open_csv(path, read_options=read_options, convert_options=convert_options)
+        for batch in reader:
+            batch = batch.filter(pc.is_in(batch.column("ImageID"), value_set=wanted))
+            if batch.num_rows == 0:
+                continue
+            xmin, xmax, ymin, ymax = (
+                batch.column(name).to_numpy(zero_copy_only=False)
+                for name in ("XMin", "XMax", "YMin", "YMax")
+            )
+            width = xmax - xmin
+            height = ymax - ymin
+            flags_bits = np.zeros(batch.num_rows, dtype=np.int64)
+            for bit, name in enumerate(BOX_FLAG_COLUMNS):
+                flag = batch.column(name).fill_null(0).to_numpy(zero_copy_only=False)
+                flags_bits |= (flag.astype(np.int64) & 3) << (2 * bit)
+
+            # one (n, 4) float32 array viewed as n 16-byte records == pack_bbox() per row
+            bboxes = np.column_stack((xmin, ymin, width, height)).astype(BBOX_DTYPE)
+            yield from zip(
+                batch.column("ImageID").to_pylist(),
+                batch.column("LabelName").to_pylist(),
+                bboxes.view(f"V{BBOX_STRUCT.size}").ravel().tolist(),
+                (width * height).tolist(),
+                flags_bits.tolist(),
+            )
+
+
+def sample_image_info(path: Path, k, rng):
+    """
+    Pick about `k` random images from one image info CSV without scanning it.
+    Seeks to `k` random byte offsets and parses the first full line after each,
+    so the cost is O(k) reads instead of O(rows). Lines that follow long lines
+    are slightly more likely to be picked; repeats are dropped and redrawn.
+    Small files (k close to the row count) are read whole and sampled instead.
+    Returns dict: image_id -> file_url
+    """
+    chosen = {}
+    with path.open("rb") as f:
+        header = next(csv.reader([f.readline().decode("utf-8")]), [])
+        id_idx, url_idxs = _image_info_columns(header, path)
+        data_start = f.tell()
+        first_line_len = len(f.readline())
+        data_size = f.seek(0, os.SEEK_END) - data_start
+        if first_line_len == 0:
+            return chosen  # header only
+
+        if 2 * k >= data_size // first_line_len:
+            rows = [
+                (img_id, file_url)
+                for _, img_id, file_url in iter_image_info({None: path})
+                if file_url
+            ]
+            return dict(rng.sample(rows, min(k, len(rows))))
+
+        for _ in range(MAX_SAMPLE_ROUNDS):
+            need = k - len(chosen)
+            if need <= 0:
+                break
+            for offset in sorted(rng.sample(range(data_start, data_start + data_size), need)):
+                f.seek(offset - 1)
+                f.readline()   # skip to the end of the line the offset landed in
+                line = f.readline()
+                if not line:
+                    continue   # landed in the last line
+                row = next(csv.reader([line.decode("utf-8")]), [])
+                if len(row) <= id_idx:
+                    continue
+                file_url = next((row[i] for i in url_idxs if i < len(row) and row[i]), "")
+                if file_url:
+                    chosen.setdefault(row[id_idx], file_url)
+
+    return chosen
+
+
+def choose_images(paths_by_split, limit, seed=SAMPLE_SEED):
     """
-    Pick up to `limit` distinct images across splits.
+    Randomly pick up to `limit` distinct images across splits, giving each
+    split a share proportional to its file size.
     Returns dict: image_id -> (split, file_url)
     """
+    rng = random.Random(seed)
+    sizes = {split: path.stat().st_size for split, path in paths_by_split.items()}
+    total = sum(sizes.values()) or 1
+
     chosen = {}
-    for split, img_id, row in image_info_iter:
-        if img_id in chosen:
-            continue
-        # prefer the smaller thumbnail if available; else fall back to OriginalURL
-        file_url = row.get("Thumbnail300KURL") or row.get("OriginalURL")
-        if not file_url:
-            continue
-        chosen[img_id] = (split, file_url)
-        if len(chosen) >= limit:
-            break
+    for split, path in paths_by_split.items():
+        quota = round(limit * sizes[split] / total)
+        for img_id, file_url in sample_image_info(path, quota, rng).items():
+            chosen.setdefault(img_id, (split, file_url))
     return chosen
 
 
@@ -163,109 +320,61 @@ def main():
 
     # -- 3) Choose which images we will import (sample) --
     print(f"Selecting up to {TARGET_IMAGE_COUNT} images...")
-    picked = choose_images(iter_image_info(IMAGE_INFO_FILES), TARGET_IMAGE_COUNT)
+    picked = choose_images(IMAGE_INFO_FILES, TARGET_IMAGE_COUNT)
     print(f"Selected {len(picked)} images.")
 
     # -- 4) Connect to unified DB & look up dataset_id for OpenImagesV7 --
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("PRAGMA foreign_keys = ON;")
-    dataset_id = get_openimages_dataset_id(conn)
-    print(f"Using dataset_id={dataset_id} for OpenImagesV7.")
+    with bulk_load_connection(DB_PATH) as conn:
+        dataset_id = get_openimages_dataset_id(conn)
+        print(f"Using dataset_id={dataset_id} for OpenImagesV7.")
 
-    # -- 5) Insert Images into unified Image table --
-    imageid_to_pk = {}      # OI ImageID -> Image.image_id PK
+        num_annotations = 0
 
-    with conn:
-        print("Inserting Image rows...")
-        for oid, (split, url) in picked.items():
+        # one transaction for the whole import: images, categories and annotations
+        with bulk_transaction(conn):
+            loader = BulkLoader(conn, dataset_id)
+
+            # -- 5) Insert Images into unified Image table --
+            print("Inserting Image rows...")
             # width/height unknown from these CSVs, keep them NULL for now
-            cur = conn.execute(
-                """
-                INSERT INTO Image (dataset_id, external_id, width, height, file_path, split)
-                VALUES (?, ?, ?, ?, ?, ?)
-                """,
-                (dataset_id, oid, None, None, url, split),
+            num_images = loader.add_images(
+                (oid, None, None, url, split) for oid, (split, url) in picked.items()
             )
-            image_pk = cur.lastrowid
-            imageid_to_pk[oid] = image_pk
-
-    print(f"Inserted {len(imageid_to_pk)} images.")
-
-    # -- 6) Insert Categories & Annotations --
-    mid_to_category_id = {}   # LabelMID -> Category.category_id
-    num_annotations = 0
-
-    with conn:
-        print("Inserting Category and Annotation rows...")
-        for split, row in iter_boxes(BOX_FILES):
-            oid = row["ImageID"]
-            image_pk = imageid_to_pk.get(oid)
-            if image_pk is None:
-                # we didn't select this image in 'picked'
-                continue
-
-            mid = row["LabelName"]   # e.g. "/m/01g317"
-            # 6a) ensure Category exists for this MID
-            if mid not in mid_to_category_id:
-                display_name = mid_to_name.get(mid, mid)
-                cur = conn.execute(
-                    """
-                    INSERT INTO Category (dataset_id, name, supercategory, external_id)
-                    VALUES (?, ?, ?, ?)
-                    """,
-                    (dataset_id, display_name, None, mid),
+            print(f"Inserted {num_images} images.")
+
+            # -- 6) Insert every boxable class up front (MID e.g. "/m/01g317") --
+            print("Inserting Category rows...")
+            loader.add_categories((name, None, mid) for mid, name in mid_to_name.items())
+
+            # -- 7) Insert Annotations --
+            def add_unknown_categories(unresolved):
+                # rare: a LabelName missing from CLASS_DESCRIPTIONS gets a Category named by MID
+                new_mids = dict.fromkeys(row[1] for row in unresolved)
+                loader.add_categories((mid, None, mid) for mid in new_mids)
+
+            print("Inserting Annotation rows...")
+            # boxes are parsed in a background thread while this one inserts
+            for batch in batched_in_background(iter_boxes(BOX_FILES, picked)):
+                # bbox: OpenImages uses normalized [0,1] coords
+                # the Is* flags go into flags_bits as one packed integer
+                num_annotations += loader.add_annotations(
+                    (
+                        (
+                            *box[:4],   # ImageID, LabelName, bbox, area
+                            None,       # is_crowd (not used in OpenImages)
+                            None,       # difficulty (not used in OpenImages)
+                            None,       # source_info
+                            box[4],     # flags_bits
+                        )
+                        for box in batch
+                    ),
+                    on_unresolved=add_unknown_categories,
                 )
-                mid_to_category_id[mid] = cur.lastrowid
-
-            category_id = mid_to_category_id[mid]
-
-            # 6b) bbox: OpenImages uses normalized [0,1] coords
-            xmin = float(row["XMin"])
-            xmax = float(row["XMax"])
-            ymin = float(row["YMin"])
-            ymax = float(row["YMax"])
-
-            bbox_xmin = xmin
-            bbox_ymin = ymin
-            bbox_width = xmax - xmin
-            bbox_height = ymax - ymin
-            area = bbox_width * bbox_height
-
-            # 6c) store some extra flags as a simple string in source_info
-            flags = [
-                f"IsOccluded={row.get('IsOccluded', '')}",
-                f"IsTruncated={row.get('IsTruncated', '')}",
-                f"IsGroupOf={row.get('IsGroupOf', '')}",
-                f"IsDepiction={row.get('IsDepiction', '')}",
-                f"IsInside={row.get('IsInside', '')}",
-            ]
-            source_info = ";".join(flags)
-
-            conn.execute(
-                """
-                INSERT INTO Annotation
-                    (image_id, category_id,
-                     bbox_xmin, bbox_ymin, bbox_width, bbox_height,
-                     area, is_crowd, difficulty, source_info)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """,
-                (
-                    image_pk,
-                    category_id,
-                    bbox_xmin,
-                    bbox_ymin,
-                    bbox_width,
-                    bbox_height,
-                    area,
-                    None,      # is_crowd (not used in OpenImages)
-                    None,      # difficulty (not used in OpenImages)
-                    source_info,
-                ),
-            )
-            num_annotations += 1
 
-    conn.close()
-    print(f"Done. Inserted {len(mid_to_category_id)} categories and {num_annotations} annotations into unified DB.")
+            (num_categories,) = conn.execute(
+                "SELECT COUNT(*) FROM Category WHERE dataset_id = ?", (dataset_id,)
+            ).fetchone()
+    print(f"Done. Inserted {num_categories} categories and {num_annotations} annotations into unified DB.")
 
 
 if __name__ == "__main__":